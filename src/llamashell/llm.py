@@ -1,53 +1,195 @@
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import torch
-from transformers import TextStreamer
-from transformers.utils import get_json_schema
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor
+from transformers import TextIteratorStreamer, StaticCache, HybridCache, DynamicCache, CompileConfig, BitsAndBytesConfig
+from transformers import StoppingCriteria, StoppingCriteriaList
+from transformers.utils import get_json_schema, is_bitsandbytes_available
+
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    mismatches = (a[:n] != b[:n]).nonzero()
+    return mismatches[0].item() if len(mismatches) else n
+
+class StopOnEvent(StoppingCriteria):
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
 
 class LLM:
+    max_cache_len = 4096
+    max_new_tokens = 2048
+    gpu_memory_utilization = 0.9
+    sampling_kwargs = {"do_sample": True, "top_p": 0.95, "temperature": 0.99}
+    greedy_kwargs = {"do_sample": False, "num_beams": 1}
+    end_of_turn_tokens = ["<|eot_id|>", "<|im_end|>", "<end_of_turn>"]
     system_message = """You are a very helpful assistant and programmer. You like to keep your answers short and to the point because you are very confident."""
 
-    def __init__(self, model_name):
+    def __init__(self, model_name, load_in_4bit=False, max_cache_len=None):
         self.model_name = model_name
+        if max_cache_len:
+            self.max_cache_len = max_cache_len
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.device = "mps" if torch.backends.mps.is_available() else self.device
         self.tokenizer.pad_token = self.tokenizer.eos_token
         self.tokenizer.padding_side = "left"
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name, torch_dtype=torch.bfloat16 if self.device != "mps" else torch.float16,
-        ).to(self.device)
-        self.streamer = TextStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
-        self.streamer.on_finalized_text = lambda text, stream_end=None: self.handle_finalized_text(text, stream_end)
+        self.quantized = load_in_4bit and self.device == "cuda" and is_bitsandbytes_available()
+        if load_in_4bit and not self.quantized:
+            print("4-bit loading needs CUDA and bitsandbytes, loading full precision weights instead.")
+        dtype = torch.bfloat16 if self.device != "mps" else torch.float16
+        if self.quantized:
+            self.model = AutoModelForCausalLM.from_pretrained(
+                model_name, torch_dtype=dtype, attn_implementation="sdpa", device_map=self.device,
+                quantization_config=BitsAndBytesConfig(
+                    load_in_4bit=True, bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=dtype, bnb_4bit_use_double_quant=True,
+                ),
+            )
+        else:
+            self.model = AutoModelForCausalLM.from_pretrained(
+                model_name, torch_dtype=dtype, attn_implementation="sdpa",
+            ).to(self.device)
+        if self.device == "cuda" and not self.quantized:
+            max_cache_len = self.measure_max_cache_len()
+            if max_cache_len <= self.max_new_tokens:
+                print("Not enough GPU memory for a preallocated KV cache, generating with a dynamic cache instead.")
+            elif max_cache_len < self.max_cache_len:
+                print(f"Not enough GPU memory for a {self.max_cache_len} token KV cache, preallocating {max_cache_len} tokens instead.")
+            self.max_cache_len = max_cache_len
+        self.cache_is_hybrid = self.model.generation_config.cache_implementation == "hybrid"
+        self.model.generation_config.cache_implementation = None
+        self.cache = None
+        if self.device != "cpu" and not self.quantized and self.max_cache_len > self.max_new_tokens:
+            cache_class = HybridCache if self.cache_is_hybrid else StaticCache
+            self.cache = cache_class(
+                config=self.model.config, max_batch_size=1, max_cache_len=self.max_cache_len,
+                device=self.device, dtype=self.model.dtype,
+            )
+        if self.quantized:
+            self.model.generation_config.disable_compile = True
+        elif self.device == "cuda":
+            self.model.generation_config.compile_config = CompileConfig(fullgraph=True, dynamic=False, mode="reduce-overhead")
+
+        self.eos_token_ids = self.get_eos_token_ids()
 
         self.chat = [
             {"role": "system", "content": self.system_message}            
         ]
         self.original_chat = self.chat.copy()
-        self.full_text = ""
+        self.past = None
+        self.past_ids = None
 
         self.model.eval()
+        self.worker = ThreadPoolExecutor(max_workers=1)
+        if self.device == "cuda" and self.cache is not None:
+            self.warm_up()
+
+    def get_eos_token_ids(self):
+        eos_token_ids = self.model.generation_config.eos_token_id
+        if not isinstance(eos_token_ids, list):
+            eos_token_ids = [eos_token_ids]
+        eos_token_ids = [t for t in eos_token_ids + [self.tokenizer.eos_token_id] if t is not None]
+        for token in self.end_of_turn_tokens:
+            token_id = self.tokenizer.convert_tokens_to_ids(token)
+            if token_id is not None and token_id != self.tokenizer.unk_token_id:
+                eos_token_ids.append(token_id)
+        return list(dict.fromkeys(eos_token_ids))
+
+    def measure_max_cache_len(self):
+        config = self.model.config
+        itemsize = self.model.dtype.itemsize
+        num_heads = config.num_attention_heads
+        num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+        intermediate_size = getattr(config, "intermediate_size", None) or 4 * config.hidden_size
+        kv_bytes_per_token = 2 * config.num_hidden_layers * num_kv_heads * head_dim * itemsize
+        prefill_bytes_per_token = (self.max_cache_len + 4 * intermediate_size + 4 * config.hidden_size) * itemsize
+        free, total = torch.cuda.mem_get_info()
+        budget = free - (1 - self.gpu_memory_utilization) * total - self.max_cache_len * prefill_bytes_per_token
+        max_cache_len = int(max(budget, 0)) // kv_bytes_per_token
+        return min(max_cache_len, self.max_cache_len, getattr(config, "max_position_embeddings", max_cache_len))
+
+    def warm_up(self):
+        inputs = self.tokenizer.apply_chat_template(self.chat, tools=None, add_generation_prompt=True, return_dict=True, return_tensors="pt")
+        inputs = inputs.to(self.device)
+
+        def generate():
+            with torch.inference_mode():
+                self.cache.reset()
+                self.model.generate(**inputs, max_new_tokens=2, **self.greedy_kwargs,
+                        pad_token_id=self.tokenizer.eos_token_id,
+                        past_key_values=self.cache
+                )
+
+        self.worker.submit(generate).result()
 
     def add_message(self, role, content):
         self.chat.append({
             "role": role, "content": content
         })
 
-    def handle_finalized_text(self, text, stream_end):
-        print(text, end="", flush=True)
-        self.full_text += text
-        if stream_end:
-            self.add_message(role="assistant", content=self.full_text)
-            self.full_text = ""
+    def prepare_cache(self, past, input_ids):
+        prompt_len = input_ids.shape[1]
+        fits = prompt_len + self.max_new_tokens <= self.max_cache_len
+        if past is not None:
+            cached = past.get_seq_length()
+            prefix = min(common_prefix_length(self.past_ids[:cached], input_ids[0]), prompt_len - 1)
+            if past is self.cache:
+                if prefix == cached and fits and not self.cache_is_hybrid:
+                    return past
+            elif prefix > 0:
+                past.crop(prefix)
+                return past
+        if self.cache is not None and fits:
+            self.cache.reset()
+            return self.cache
+        return DynamicCache()
 
-    def send_message(self, message):
+    def send_message(self, message, sample=True):
         self.add_message(role="user", content=message)
-        inputs = self.tokenizer.apply_chat_template(self.chat, tools=None, add_generation_prompt=True, return_dict=True, return_tensors="pt")
-        inputs = inputs.to(self.device)
-        inputs = {k: v for k, v in inputs.items()}
-        self.model.generate(**inputs, max_new_tokens=2048, 
-                do_sample=True, top_p=0.95, temperature=0.99,
-                pad_token_id=self.tokenizer.eos_token_id,
-                streamer=self.streamer
-        )
-
-    
\ No newline at end of file
+        stop = Event()
+        future = None
+        finished = False
+        try:
+            inputs = self.tokenizer.apply_chat_template(self.chat, tools=None, add_generation_prompt=True, return_dict=True, return_tensors="pt")
+            inputs = inputs.to(self.device)
+            input_len = inputs["input_ids"].shape[1]
+            past = self.past
+            self.past = None
+            streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+
+            def generate():
+                try:
+                    with torch.inference_mode():
+                        cache = self.prepare_cache(past, inputs["input_ids"])
+                        return cache, self.model.generate(**inputs, max_new_tokens=self.max_new_tokens,
+                                **(self.sampling_kwargs if sample else self.greedy_kwargs),
+                                pad_token_id=self.tokenizer.eos_token_id,
+                                eos_token_id=self.eos_token_ids,
+                                past_key_values=cache,
+                                stopping_criteria=StoppingCriteriaList([StopOnEvent(stop)]),
+                                streamer=streamer
+                        )
+                except Exception:
+                    streamer.end()
+                    raise
+
+            future = self.worker.submit(generate)
+            for text in streamer:
+                yield text
+            finished = True
+        finally:
+            stop.set()
+            error = future.exception() if future else None
+            if not finished or error:
+                self.chat.pop()
+        self.past, outputs = future.result()
+        self.past_ids = outputs[0]
+        output = self.tokenizer.decode(outputs[0, input_len:], skip_special_tokens=True)
+        self.add_message(role="assistant", content=output)
@@ -5,9 +5,11 @@ import os
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--model", type=str, default="meta-llama/Llama-3.2-1B-Instruct", help="LLM to use")
+    parser.add_argument("--load-in-4bit", action="store_true", help="Quantize the LLM to 4 bits on CUDA (requires bitsandbytes)")
+    parser.add_argument("--max-cache-len", type=int, default=4096, help="Size in tokens of the preallocated KV cache on GPUs; longer conversations use a dynamic cache")
     args = parser.parse_args()
     os.environ["TOKENIZERS_PARALLELISM"] = "false"
-    main_loop(args.model)
+    main_loop(args.model, load_in_4bit=args.load_in_4bit, max_cache_len=args.max_cache_len)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -29,9 +29,14 @@ LOGO = """
 """
 
 previous_directory = "~"
+prompt_message = None
 history_path = os.path.expanduser("~/.llamashell_history")
 history = FileHistory(history_path)
 
+def update_prompt_message():
+    global prompt_message
+    prompt_message = [('class:prompt', f'{os.getcwd()}> ')]
+
 def show_welcome():
     print(f"{BOLD}{YELLOW}{LOGO}\nVersion {__VERSION__}{RESET}")
 
@@ -69,50 +74,109 @@ def expand_variables(user_input):
     expanded = re.sub(pattern, replace_var, user_input)
     return expanded
 
+PLAIN_RUN = re.compile(r"[^\s'\"\\|]+")
+QUOTED_RUN = re.compile(r'[^"\\]+')
+WHITESPACE = re.compile(r"\s*")
+REDIRECTIONS = {
+    "<": ("input_file", "Missing input file after '<'"),
+    ">": ("output_file", "Missing output file after '>'"),
+    ">>": ("append_file", "Missing output file after '>>'"),
+}
+
+def tokenize_input(user_input):
+    i = 0
+    n = len(user_input)
+    while True:
+        i = WHITESPACE.match(user_input, i).end()
+        if i >= n:
+            return
+        c = user_input[i]
+        if c == "|":
+            yield "|", None
+            i += 1
+            continue
+        word = []
+        quoted = False
+        while i < n:
+            c = user_input[i]
+            if c.isspace() or c == "|":
+                break
+            if c == "'":
+                end = user_input.find("'", i + 1)
+                if end == -1:
+                    raise ValueError("No closing quotation")
+                word.append(user_input[i + 1:end])
+                quoted = quoted or end > i + 1
+                i = end + 1
+            elif c == '"':
+                i += 1
+                while True:
+                    if i >= n:
+                        raise ValueError("No closing quotation")
+                    c = user_input[i]
+                    if c == '"':
+                        i += 1
+                        break
+                    if c == "\\" and i + 1 >= n:
+                        raise ValueError("No escaped character")
+                    quoted = True
+                    if c == "\\" and user_input[i + 1] in '"\\':
+                        word.append(user_input[i + 1])
+                        i += 2
+                        continue
+                    match = QUOTED_RUN.match(user_input, i)
+                    end = match.end() if match else i + 1
+                    word.append(user_input[i:end])
+                    i = end
+            elif c == "\\":
+                if i + 1 >= n:
+                    raise ValueError("No escaped character")
+                word.append(user_input[i + 1])
+                quoted = True
+                i += 2
+            else:
+                end = PLAIN_RUN.match(user_input, i).end()
+                word.append(user_input[i:end])
+                i = end
+        word = "".join(word)
+        if not quoted and word in REDIRECTIONS:
+            yield word, None
+        else:
+            yield "arg", word
+
+def new_command():
+    return {
+        "args": [],
+        "input_file": None,
+        "output_file": None,
+        "append_file": None
+    }
+
 def parse_input(user_input):
     user_input = expand_variables(user_input)
-    if "|" in user_input:
-        commands = [shlex.split(cmd.strip()) for cmd in user_input.split("|")]
-    else:
-        commands = [shlex.split(user_input)]
-    
     parsed_commands = []
-    for cmd in commands:
-        if not cmd:
-            continue
-        input_file = output_file = append_file = None
-        cmd_args = []
-        i = 0
-        while i < len(cmd):
-            if cmd[i] == "<":
-                if i + 1 < len(cmd):
-                    input_file = cmd[i + 1]
-                    i += 2
-                else:
-                    raise ValueError("Missing input file after '<'")
-            elif cmd[i] == ">":
-                if i + 1 < len(cmd):
-                    output_file = cmd[i + 1]
-                    i += 2
-                else:
-                    raise ValueError("Missing output file after '>'")
-            elif cmd[i] == ">>":
-                if i + 1 < len(cmd):
-                    append_file = cmd[i + 1]
-                    i += 2
-                else:
-                    raise ValueError("Missing output file after '>>'")
-            else:
-                cmd_args.append(cmd[i])
-                i += 1
-        if cmd_args:
-            parsed_commands.append({
-                "args": cmd_args,
-                "input_file": input_file,
-                "output_file": output_file,
-                "append_file": append_file
-            })
-    
+    command = new_command()
+    redirection = None
+    for kind, value in tokenize_input(user_input):
+        if redirection:
+            key, error = REDIRECTIONS[redirection]
+            if kind != "arg":
+                raise ValueError(error)
+            command[key] = value
+            redirection = None
+        elif kind == "arg":
+            command["args"].append(value)
+        elif kind == "|":
+            if command["args"]:
+                parsed_commands.append(command)
+            command = new_command()
+        else:
+            redirection = kind
+    if redirection:
+        raise ValueError(REDIRECTIONS[redirection][1])
+    if command["args"]:
+        parsed_commands.append(command)
+
     return parsed_commands
 
 def execute_command(command, stdin=None, stdout=subprocess.PIPE):
@@ -143,6 +207,7 @@ def execute_command(command, stdin=None, stdout=subprocess.PIPE):
             os.environ["OLDPWD"] = previous_directory            
             os.chdir(target)
             os.environ["PWD"] = target
+            update_prompt_message()
             return True
         except Exception as e:
             print(f"{RED}cd: {e}{RESET}")
@@ -166,20 +231,26 @@ def execute_command(command, stdin=None, stdout=subprocess.PIPE):
             print(f"{RED}Error: {e}{RESET}")
             return True
 
-    stdin_file = stdin if stdin else (open(input_file, "r") if input_file else None)
-    stdout_file = open(output_file, "w") if output_file else open(append_file, "a") if append_file else stdout
-
+    stdin_fd = stdout_fd = None
     try:
+        if input_file and not stdin:
+            stdin_fd = os.open(input_file, os.O_RDONLY)
+        if output_file or append_file:
+            mode = os.O_TRUNC if output_file else os.O_APPEND
+            stdout_fd = os.open(output_file or append_file, os.O_WRONLY | os.O_CREAT | mode, 0o644)
         process = subprocess.Popen(
             args,
-            stdin=stdin_file,
-            stdout=stdout_file,
+            stdin=stdin if stdin else stdin_fd,
+            stdout=stdout if stdout_fd is None else stdout_fd,
             stderr=subprocess.PIPE,
             text=True
         )
         return process
-    except FileNotFoundError:
-        print(f"{RED}{args[0]}: command not found{RESET}")
+    except FileNotFoundError as e:
+        if e.filename in (input_file, output_file, append_file):
+            print(f"{RED}{e.filename}: {e.strerror}{RESET}")
+        else:
+            print(f"{RED}{args[0]}: command not found{RESET}")
         return None
     except subprocess.CalledProcessError as e:
         print(f"{RED}Error: {e}{RESET}")
@@ -188,10 +259,9 @@ def execute_command(command, stdin=None, stdout=subprocess.PIPE):
         print(f"{RED}Error: {e}{RESET}")
         return None
     finally:
-        if input_file and stdin_file:
-            stdin_file.close()
-        if (output_file or append_file) and stdout_file != subprocess.PIPE:
-            stdout_file.close()
+        for fd in (stdin_fd, stdout_fd):
+            if fd is not None:
+                os.close(fd)
 
 def execute_pipeline(commands):
     if not commands:
@@ -229,21 +299,22 @@ def execute_pipeline(commands):
 
     return True
 
-def main_loop(llm_name):
+def main_loop(llm_name, load_in_4bit=False, max_cache_len=None):
     llm_name = llm_name.strip().lower()
     show_welcome()
     style = Style.from_dict({
         'prompt': 'bold #00cccc'
     })
+    update_prompt_message()
     session = PromptSession(
         history=history,
         style=style,
-        message=lambda: [('class:prompt', f'{os.getcwd()}> ')],
+        message=lambda: prompt_message,
         completer=ShellCompleter(),
         complete_while_typing=False
     )
     print(f"""{YELLOW}Loading {llm_name.split("/")[1]}...{RESET}""")
-    llm = LLM(llm_name)
+    llm = LLM(llm_name, load_in_4bit=load_in_4bit, max_cache_len=max_cache_len)
     print(f"{YELLOW}LLM is now ready.{RESET}")
 
     while True:
@@ -254,10 +325,13 @@ def main_loop(llm_name):
             if user_input.startswith("-- "):
                 print(f"{BOLD}{YELLOW}{llm_name}: {RESET}")
                 print(f"{YELLOW}")
-                llm.send_message(
-                    user_input[3:]
-                )
-                print(f"{RESET}")
+                reply = llm.send_message(user_input[3:])
+                try:
+                    for text in reply:
+                        print(text, end="", flush=True)
+                finally:
+                    reply.close()
+                    print(f"{RESET}")
                 continue
             if user_input.startswith("--save-chat-logs"):
                 contents = "\n\n".join([f"{history_item['role']}: {history_item['content']}" for history_item in llm.chat])